@@ -1,16 +1,34 @@
 import pandas as pd
 import os
+import shutil
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from pandas.tseries.api import guess_datetime_format
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the NumPy version below is used instead
+    njit = None
 
 # ============================================================================
 # COMPREHENSIVE BLE DATA MERGING 
 # ============================================================================
 # This script performs the following operations:
-# 1. Merges all individual BLE CSV files
-# 2. Transforms data structure and adds date/time columns
-# 3. Adds RSSI_1..RSSI_25 binary columns per row (no pivot)
-# 4. Preserves fractional seconds and ordering; no row drops
-# 5. Optionally removes timezone indicator without altering milliseconds
+# 1. Merges all individual BLE CSV files, transforming each file as it is read:
+#    adds date/time columns and a per-row rssi_mask (no pivot), and orders rows
+#    by user_id then timestamp
+# 2. Fixes the final column order, optionally expanding rssi_mask back into
+#    the legacy RSSI_1..RSSI_25 binary columns
+# 3. Preserves fractional seconds and ordering; no row drops
+# 4. Optionally removes timezone indicator without altering milliseconds
+#
+# RSSI flags are stored as one uint32 column, rssi_mask: bit i (value 2**i) is
+# set when the row's mac is the beacon mapped to RSSI_{i+1}, and the mask is 0
+# for macs outside the beacon dictionary. unpack_mask() recovers the 25 columns.
 # ============================================================================
 
 def setup_beacon_dictionary():
@@ -45,12 +63,14 @@ def setup_beacon_dictionary():
     return mac_to_rssi_column
 
 
-def merge_individual_csv_files(dataset_directory):
+def merge_individual_csv_files(dataset_directory, mac_to_rssi_column):
     """
     STEP 1: Merge all individual BLE CSV files from the dataset directory
+    Each file is parsed and transformed on its own, so the raw and transformed
+    data are never both resident for the whole dataset.
     """
     print("=" * 80)
-    print("STEP 1: MERGING INDIVIDUAL CSV FILES")
+    print("STEP 1: MERGING AND TRANSFORMING INDIVIDUAL CSV FILES")
     print("=" * 80)
     
     # Always merge from source CSVs to avoid any prior transformations
@@ -60,18 +80,54 @@ def merge_individual_csv_files(dataset_directory):
     
     print(f"Found {len(csv_files)} CSV files to merge")
     
-    all_dfs = []
-    for csv_file in csv_files:
+    # Fixed schema for the headerless raw files (no type inference), built once
+    # and shared by every read
+    read_options = pacsv.ReadOptions(column_names=['pid', 'timestamp', 'column3', 'mac_address', 'rssi', 'column6'])
+    convert_options = pacsv.ConvertOptions(
+        column_types={
+            'pid': pa.int64(),
+            'timestamp': pa.string(),
+            'column3': pa.string(),
+            'mac_address': pa.string(),
+            # RSSI readings are small integers in dBm; float32 halves the column
+            'rssi': pa.float32(),
+            'column6': pa.string(),
+        },
+        # Treat the same tokens as missing as pd.read_csv does, in string columns too
+        null_values=['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                     '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'],
+        strings_can_be_null=True,
+    )
+    
+    def process_one(csv_file):
         file_path = os.path.join(dataset_directory, csv_file)
         try:
-            df_temp = pd.read_csv(file_path, header=None, dtype={0: 'int64', 1: 'string', 2: 'string', 3: 'string', 4: 'float64', 5: 'string'})
-            df_temp.columns = ['pid', 'timestamp', 'column3', 'mac_address', 'rssi', 'column6']
-            all_dfs.append(df_temp)
+            # Memory-map the file so the parser reads straight from the page cache
+            with pa.memory_map(file_path) as source:
+                table = pacsv.read_csv(source, read_options=read_options, convert_options=convert_options)
+            # Arrow's int64 accepts blank values; reject such files as pd.read_csv did
+            if table['pid'].null_count:
+                raise ValueError("Integer column 'pid' has NA values")
         except Exception as e:
             print(f"Error reading {csv_file}: {e}")
+            return None
+        return transform_file_data(table.to_pandas(types_mapper=pd.ArrowDtype), mac_to_rssi_column)
+    
+    # Process files concurrently; Arrow's reader releases the GIL while parsing.
+    # executor.map keeps results in file order so the merge stays deterministic.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        all_dfs = [df_temp for df_temp in executor.map(process_one, csv_files) if df_temp is not None and len(df_temp)]
     
     if all_dfs:
-        df = pd.concat(all_dfs, ignore_index=True)
+        # Give every file the same mac categories so the merged column stays categorical
+        mac_categories = list(mac_to_rssi_column.keys())
+        mac_categories += sorted(set().union(*(df_temp['mac_address'].cat.categories for df_temp in all_dfs)) - set(mac_categories))
+        for df_temp in all_dfs:
+            df_temp['mac_address'] = df_temp['mac_address'].cat.set_categories(mac_categories)
+        
+        # Every frame already carries its final columns, so concatenate once,
+        # ordered by user_id then timestamp
+        df = concat_sorted_by_user(all_dfs)
         print(f"Successfully merged {len(all_dfs)} files")
         print(f"Total rows: {len(df)}\n")
     else:
@@ -81,29 +137,84 @@ def merge_individual_csv_files(dataset_directory):
     return df
 
 
-def transform_and_flag_data(df, mac_to_rssi_column):
+def parse_timestamps(timestamps):
     """
-    STEP 2: Transform data structure and add per-row RSSI flags without pivoting
-    Preserves every input row and fractional seconds, keeps ordering.
+    Parse timestamp strings using the format detected from the first value.
+    Falls back to mixed-format parsing only for rows that do not match it.
     """
-    print("=" * 80)
-    print("STEP 2: TRANSFORMING DATA (NO PIVOT)")
-    print("=" * 80)
+    non_null = timestamps.dropna()
+    fmt = guess_datetime_format(non_null.iloc[0]) if len(non_null) else None
+    if fmt is None:
+        return pd.to_datetime(timestamps, format='mixed', errors='coerce')
     
+    # Single vectorized pass with the detected format
+    dt = pd.to_datetime(timestamps, format=fmt, errors='coerce')
+    # Rows in another format (e.g. without fractional seconds) get a second chance
+    unmatched = dt.isna() & timestamps.notna()
+    if unmatched.any():
+        fallback = pd.to_datetime(timestamps[unmatched], format='mixed', errors='coerce').dropna()
+        try:
+            dt[fallback.index] = fallback
+        except (TypeError, ValueError):
+            # e.g. a different timezone offset: parse the whole column as before
+            return pd.to_datetime(timestamps, format='mixed', errors='coerce')
+    return dt
+
+
+if njit is not None:
+    # Compiled single pass over the codes. nogil lets the per-file worker threads
+    # run it concurrently, which is where the parallelism already comes from.
+    @njit(nogil=True, cache=True)
+    def rssi_mask_kernel(codes, n_beacons):
+        mask = np.zeros(codes.size, dtype=np.uint32)
+        for i in range(codes.size):
+            code = codes[i]
+            if code >= 0 and code < n_beacons:
+                mask[i] = np.uint32(1) << np.uint32(code)
+        return mask
+
+
+def rssi_mask_bits(codes, n_beacons):
+    """
+    Build the uint32 per-row beacon bitmask from mac category codes (bit i set
+    for beacon i). Codes outside 0..n_beacons-1 (other or missing macs) give 0.
+    """
+    if njit is not None:
+        return rssi_mask_kernel(codes, n_beacons)
+    known = (codes >= 0) & (codes < n_beacons)
+    shifts = np.where(known, codes, 0).astype(np.uint32)
+    return np.where(known, np.left_shift(np.uint32(1), shifts), np.uint32(0))
+
+
+def unpack_mask(mask, n_beacons=25):
+    """
+    Expand rssi_mask values into the legacy wide uint8 matrix, where column i
+    is the RSSI_{i+1} flag (bit i of the mask).
+    """
+    mask_bytes = np.ascontiguousarray(mask, dtype='<u4').view(np.uint8).reshape(-1, 4)
+    return np.unpackbits(mask_bytes, axis=1, bitorder='little')[:, :n_beacons]
+
+
+def transform_file_data(df, mac_to_rssi_column):
+    """
+    Transform the rows of a single source file: parse timestamps, add date/time
+    columns and per-row RSSI flags. Preserves every input row and fractional seconds.
+    """
     # Convert timestamp to datetime preserving fractional seconds and mixed formats
-    print("Converting timestamps...")
-    dt = pd.to_datetime(df['timestamp'], format='mixed', errors='coerce')
+    dt = parse_timestamps(df['timestamp'])
     # If timestamps are timezone-aware, strip tz without changing the time
-    try:
+    if getattr(dt.dtype, 'tz', None) is not None:
         dt = dt.dt.tz_localize(None)
-    except Exception:
-        pass
     df['timestamp'] = dt
     
     # Extract date and time columns
-    print("Extracting date and time information...")
-    df['year_month_day'] = df['timestamp'].dt.strftime('%Y-%m-%d')
-    df['hour'] = df['timestamp'].dt.hour
+    timestamps = df['timestamp'].to_numpy()
+    # Truncate to day as a datetime64 column rather than building per-row strings
+    df['year_month_day'] = timestamps.astype('datetime64[D]')
+    # Hour of day straight from the integer hour count (timestamps are tz-naive here).
+    # Fits in one byte; Arrow-backed so unparseable timestamps stay null
+    hours = (timestamps.astype('datetime64[h]').view('int64') % 24).astype(np.uint8)
+    df['hour'] = pd.arrays.ArrowExtensionArray(pa.array(hours, mask=np.isnat(timestamps)))
     
     # Rename columns
     df = df.rename(columns={
@@ -112,50 +223,183 @@ def transform_and_flag_data(df, mac_to_rssi_column):
         'column6': 'power'
     })
     
-    # Build RSSI_1..RSSI_25 binary flags per row (1 if this row belongs to that beacon)
-    print("Building RSSI_1..RSSI_25 binary columns per row...")
-    rssi_cols = [f'RSSI_{i}' for i in range(1, 26)]
-    for col in rssi_cols:
-        df[col] = 0
-    # Map each mac to its target RSSI_* column
-    df['rssi_target_col'] = df['mac_address'].map(mac_to_rssi_column)
-    # Set flag 1 for the corresponding column for each row
-    for col in rssi_cols:
-        df.loc[df['rssi_target_col'] == col, col] = 1
-    df.drop(columns=['rssi_target_col'], inplace=True)
-    
-    # Sort to ensure stable ordering: by user_id then timestamp, preserving duplicates
-    print("Sorting data by user_id and timestamp while preserving all rows...")
-    df = df.sort_values(by=['user_id', 'timestamp'], kind='mergesort').reset_index(drop=True)
+    # Dictionary-encode mac_address: beacon macs first so a row's code is its
+    # beacon index, then any other macs seen so they are kept in the output
+    beacon_macs = list(mac_to_rssi_column.keys())
+    other_macs = sorted(set(df['mac_address'].dropna().unique()) - set(beacon_macs))
+    df['mac_address'] = pd.Categorical(df['mac_address'], categories=beacon_macs + other_macs)
     
-    # Final column order
-    columns_order = ['user_id', 'timestamp', 'mac_address', 'RSSI', 'power', 'year_month_day', 'hour'] + rssi_cols
-    df = df[columns_order]
+    # Pack the per-row beacon flags into one uint32: bit i set means RSSI_{i+1}
+    codes = df['mac_address'].cat.codes.to_numpy()
+    df['rssi_mask'] = rssi_mask_bits(codes, len(beacon_macs))
     
-    print(f"Data transformed successfully (no pivot). Total rows: {len(df)}\n")
-    return df
+    # Stable sort of this file alone; the merge then only has to order whole files
+    return df.sort_values(by='timestamp', kind='mergesort')
+
 
+def concat_frames(frames):
+    """
+    Concatenate frames that share one schema into columns sized once up front,
+    skipping pd.concat's block-manager rebuild. The result has a fresh RangeIndex.
+    """
+    if any(not frame.dtypes.equals(frames[0].dtypes) for frame in frames[1:]):
+        # Schemas drifted between files (e.g. timestamp resolution): let pandas reconcile
+        return pd.concat(frames, ignore_index=True)
+    
+    total = sum(len(frame) for frame in frames)
+    columns = {}
+    for name, dtype in frames[0].dtypes.items():
+        if isinstance(dtype, pd.ArrowDtype):
+            # Arrow columns are stitched together from their existing chunks without copying
+            chunks = []
+            for frame in frames:
+                arrow_data = pa.array(frame[name].array)
+                chunks.extend(arrow_data.chunks if isinstance(arrow_data, pa.ChunkedArray) else [arrow_data])
+            columns[name] = pd.arrays.ArrowExtensionArray(pa.chunked_array(chunks, type=dtype.pyarrow_dtype))
+            continue
+        
+        # NumPy and categorical columns: fill one preallocated buffer slice by slice
+        is_category = isinstance(dtype, pd.CategoricalDtype)
+        parts = [frame[name].cat.codes.to_numpy() if is_category else frame[name].to_numpy() for frame in frames]
+        buffer = np.empty(total, dtype=parts[0].dtype)
+        offset = 0
+        for part in parts:
+            buffer[offset:offset + len(part)] = part
+            offset += len(part)
+        columns[name] = pd.Categorical.from_codes(buffer, dtype=dtype) if is_category else buffer
+    
+    return pd.DataFrame(columns, copy=False)
+
+
+def concat_sorted_by_user(all_dfs):
+    """
+    Concatenate per-file frames (each already sorted by timestamp) in
+    user_id/timestamp order without sorting the merged frame as a whole.
+    """
+    frames_by_user = {}
+    for df_temp in all_dfs:
+        users = df_temp['user_id'].unique()
+        if len(users) != 1 or pd.isna(users[0]):
+            # A file mixing several users: fall back to one global stable sort
+            df = concat_frames(all_dfs)
+            return df.sort_values(by=['user_id', 'timestamp'], kind='mergesort').reset_index(drop=True)
+        frames_by_user.setdefault(users[0], []).append(df_temp)
+    
+    ordered = []
+    for user_id in sorted(frames_by_user):
+        frames = frames_by_user[user_id]
+        if len(frames) == 1:
+            ordered.append(frames[0])
+        else:
+            # Same user spread over several files: only these rows need merging
+            ordered.append(concat_frames(frames).sort_values(by='timestamp', kind='mergesort'))
+    return concat_frames(ordered)
 
-def convert_rssi_to_binary(df):
+
+def order_columns(df, legacy_wide=False):
     """
-    STEP 3: (No-op) RSSI_1..RSSI_25 are already binary flags per row.
-    Keeping this for pipeline compatibility.
+    STEP 2: Fix the final column order
+    Timestamps and the RSSI bitmask are built per file, and rows are already ordered
+    by user_id then timestamp (preserving duplicates) during the merge.
+    With legacy_wide=True the bitmask is expanded back into RSSI_1..RSSI_25 columns.
     """
     print("=" * 80)
-    print("STEP 3: RSSI FLAGS ALREADY BINARY – SKIPPING")
+    print("STEP 2: ORDERING COLUMNS")
     print("=" * 80)
+    
+    columns_order = ['user_id', 'timestamp', 'mac_address', 'RSSI', 'power', 'year_month_day', 'hour']
+    
+    if legacy_wide:
+        print("Expanding rssi_mask into RSSI_1..RSSI_25 binary columns...")
+        rssi_cols = [f'RSSI_{i}' for i in range(1, 26)]
+        df[rssi_cols] = unpack_mask(df['rssi_mask'].to_numpy(), len(rssi_cols))
+        columns_order += rssi_cols
+    else:
+        columns_order += ['rssi_mask']
+    
+    # Final column order
+    df = df[columns_order]
+    
+    print(f"Columns ordered successfully. Total rows: {len(df)}\n")
     return df
 
 
-def save_output(df, output_path):
+def needs_quoting(table):
+    """True if any string value in the table contains a comma, quote or line break"""
+    for column in table.itercolumns():
+        for chunk in column.chunks:
+            # Categorical columns only need their dictionary checked
+            values = chunk.dictionary if pa.types.is_dictionary(chunk.type) else chunk
+            is_string = pa.types.is_string(values.type) or pa.types.is_large_string(values.type)
+            if is_string and pc.any(pc.match_substring_regex(values, r'[,"\r\n]')).as_py():
+                return True
+    return False
+
+
+def save_output(df, output_path, output_format='csv'):
     """
-    STEP 4: Save the final result to CSV file
+    STEP 3: Save the final result to a CSV or Parquet file
+    With output_format='parquet' the extension of output_path is replaced by .parquet
     """
     print("=" * 80)
-    print("STEP 4: SAVING OUTPUT FILE")
+    print("STEP 3: SAVING OUTPUT FILE")
     print("=" * 80)
     
-    df.to_csv(output_path, index=False)
+    # Arrow schema shared by every block; both writers below format columns in C++
+    schema = pa.Schema.from_pandas(df.iloc[:0], preserve_index=False)
+    # Write the day column as a plain date rather than a midnight timestamp
+    day_index = schema.get_field_index('year_month_day')
+    if day_index >= 0:
+        schema = schema.set(day_index, pa.field('year_month_day', pa.date32()))
+    
+    if output_format == 'parquet':
+        output_path = os.path.splitext(output_path)[0] + '.parquet'
+        # Convert and write a bounded number of rows at a time; each block becomes
+        # one row group regardless of how the rows split across users
+        row_group_size = 1_000_000
+        with pq.ParquetWriter(output_path, schema, compression='zstd', use_dictionary=['mac_address']) as writer:
+            for start in range(0, len(df), row_group_size):
+                block = df.iloc[start:start + row_group_size]
+                writer.write_table(pa.Table.from_pandas(block, schema=schema, preserve_index=False))
+    else:
+        # Convert and write one run of user_id at a time (the merge leaves each user's
+        # rows contiguous), so one participant's rows are in flight rather than the whole frame
+        user_codes = pd.factorize(df['user_id'])[0]
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(user_codes)) + 1, [len(df)]))
+        blocks = list(zip(bounds[:-1], bounds[1:]))
+        
+        # Split the blocks into row-balanced stripes and format each stripe into its
+        # own part file concurrently (Arrow's CSV formatter releases the GIL)
+        n_stripes = min(os.cpu_count() or 1, len(blocks))
+        block_stripes = bounds[:-1] * n_stripes // max(len(df), 1)
+        part_paths = [f"{output_path}.part{i}" for i in range(n_stripes)]
+        
+        def write_stripe(i):
+            stripe = [block for block, stripe_index in zip(blocks, block_stripes) if stripe_index == i]
+            with open(part_paths[i], 'wb') as part:
+                for start, stop in stripe:
+                    table = pa.Table.from_pandas(df.iloc[start:stop], schema=schema, preserve_index=False)
+                    # Leave values unquoted unless one in this block would break the CSV
+                    # (comma, quote, line break); the style is picked once per block
+                    options = pacsv.WriteOptions(
+                        include_header=(start == 0),
+                        quoting_style='needed' if needs_quoting(table) else 'none',
+                        quoting_header='none',
+                    )
+                    pacsv.write_csv(table, part, options)
+        
+        try:
+            with ThreadPoolExecutor(max_workers=n_stripes) as executor:
+                list(executor.map(write_stripe, range(n_stripes)))
+            # CSV is append-safe: stitch the parts together in order (header is in part 0)
+            with open(output_path, 'wb') as output:
+                for part_path in part_paths:
+                    with open(part_path, 'rb') as part:
+                        shutil.copyfileobj(part, output)
+        finally:
+            for part_path in part_paths:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
     
     print(f"File saved successfully: {output_path}")
     print(f"Total rows: {len(df)}")
@@ -177,9 +421,13 @@ def display_summary(df):
     print(f"\nData shape: {df.shape}")
     print(f"Data types:\n{df.dtypes}")
     
-    rssi_cols = [f'RSSI_{i}' for i in range(1, 26)]
-    print(f"\nRSSI columns sample (binary values):")
-    print(df[['user_id', 'timestamp'] + rssi_cols[:10]].head(5))
+    if 'rssi_mask' in df.columns:
+        print(f"\nRSSI bitmask sample (bit i set = RSSI_{{i+1}}):")
+        print(df[['user_id', 'timestamp', 'mac_address', 'rssi_mask']].head(5))
+    else:
+        rssi_cols = [f'RSSI_{i}' for i in range(1, 26)]
+        print(f"\nRSSI columns sample (binary values):")
+        print(df[['user_id', 'timestamp'] + rssi_cols[:10]].head(5))
 
 
 def main():
@@ -193,24 +441,23 @@ def main():
     # Configuration
     dataset_directory = r"c:\Users\umroot\Desktop\BLE Data"
     output_file = r"c:\Users\umroot\Desktop\BLE Data\BLEdata3.csv"
+    output_format = 'csv'  # or 'parquet' for a much smaller, faster-to-read file
+    legacy_wide = False  # True writes RSSI_1..RSSI_25 columns instead of rssi_mask (same values, see README)
     
     # Get beacon dictionary
     mac_to_rssi_column = setup_beacon_dictionary()
     
     # Step 1: Merge individual CSV files
-    df = merge_individual_csv_files(dataset_directory)
+    df = merge_individual_csv_files(dataset_directory, mac_to_rssi_column)
     if df is None:
         print("Error: Could not load data")
         return
     
-    # Step 2: Transform without pivot; keep all rows
-    df = transform_and_flag_data(df, mac_to_rssi_column)
-    
-    # Step 3: Convert RSSI to binary
-    df = convert_rssi_to_binary(df)
+    # Step 2: Order columns; keep all rows
+    df = order_columns(df, legacy_wide)
     
-    # Step 4: Save output
-    df = save_output(df, output_file)
+    # Step 3: Save output
+    df = save_output(df, output_file, output_format)
     
     # Display summary
     display_summary(df)